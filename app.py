@@ -1,543 +1,907 @@
-"""
-P&L RECONCILIATION AI AGENT - COMPLETE WORKING VERSION
-Reads ALL sheets and provides accurate answers
-"""
-
-import streamlit as st
-import pandas as pd
-import json
-import gspread
-from google.oauth2.service_account import Credentials
-import google.generativeai as genai
-from datetime import datetime
-import time
-import re
-
-# Page config
-st.set_page_config(
-    page_title="P&L Reconciliation AI Agent",
-    page_icon="🤖",
-    layout="wide"
-)
-
-# Custom CSS
-st.markdown("""
-<style>
-    .main-header {
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        padding: 30px;
-        border-radius: 15px;
-        color: white;
-        text-align: center;
-        margin-bottom: 30px;
-    }
-    .chat-message {
-        padding: 15px;
-        border-radius: 10px;
-        margin: 10px 0;
-    }
-    .user-message {
-        background: #e3f2fd;
-        border-left: 4px solid #2196F3;
-        margin-left: 50px;
-    }
-    .ai-message {
-        background: #f3e5f5;
-        border-left: 4px solid #9c27b0;
-        margin-right: 50px;
-    }
-    .metric-card {
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        padding: 20px;
-        border-radius: 10px;
-        color: white;
-        text-align: center;
-    }
-</style>
-""", unsafe_allow_html=True)
-
-# Initialize session state
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-if "all_data" not in st.session_state:
-    st.session_state.all_data = {}
-if "connected" not in st.session_state:
-    st.session_state.connected = False
-
-@st.cache_resource
-def init_services(spreadsheet_id, creds_dict, gemini_key):
-    """Initialize Google Sheets and Gemini"""
-    try:
-        scopes = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        credentials = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-        client = gspread.authorize(credentials)
-        spreadsheet = client.open_by_key(spreadsheet_id)
-        
-        genai.configure(api_key=gemini_key)
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        
-        return spreadsheet, model, None
-    except Exception as e:
-        return None, None, str(e)
-
-def load_all_sheets(spreadsheet):
-    """Load ALL sheets into memory"""
-    try:
-        all_data = {}
-        
-        # Define sheets to load
-        sheets_to_load = {
-            "01_Expected": "B:U",
-            "02_Payouts": "B:AE", 
-            "03_MCFExport": "C:CE",
-            "04_Invoice": "A:J",
-            "Master Reconciliation": "A:W"
-        }
-        
-        for sheet_name, range_notation in sheets_to_load.items():
-            try:
-                ws = spreadsheet.worksheet(sheet_name)
-                data = ws.get_all_values()
-                
-                if data and len(data) > 1:
-                    df = pd.DataFrame(data[1:], columns=data[0])
-                    df.columns = df.columns.str.strip()
-                    all_data[sheet_name] = df
-                    st.success(f"✅ Loaded {sheet_name}: {len(df)} rows")
-                else:
-                    st.warning(f"⚠️ {sheet_name} is empty")
-                    
-            except Exception as e:
-                st.error(f"❌ Error loading {sheet_name}: {e}")
-        
-        return all_data
-        
-    except Exception as e:
-        st.error(f"Error loading sheets: {e}")
-        return {}
-
-def smart_search(df, search_term, columns_to_search):
-    """Smart search across multiple columns"""
-    if df is None or df.empty:
-        return pd.DataFrame()
-    
-    search_lower = str(search_term).lower().strip()
-    
-    # Try exact match first
-    for col in columns_to_search:
-        if col in df.columns:
-            exact = df[df[col].astype(str).str.lower() == search_lower]
-            if not exact.empty:
-                return exact
-    
-    # Try contains match
-    for col in columns_to_search:
-        if col in df.columns:
-            contains = df[df[col].astype(str).str.lower().str.contains(search_lower, na=False, regex=False)]
-            if not contains.empty:
-                return contains
-    
-    # Try partial word match
-    words = search_lower.split()
-    if len(words) > 1:
-        for col in columns_to_search:
-            if col in df.columns:
-                mask = df[col].astype(str).str.lower().apply(
-                    lambda x: all(word in x for word in words)
-                )
-                word_match = df[mask]
-                if not word_match.empty:
-                    return word_match
-    
-    return pd.DataFrame()
-
-def chat_with_agent(user_message, all_data):
-    """Intelligent agent that understands and helps"""
-    
-    if not all_data or "Master Reconciliation" not in all_data:
-        return {
-            "type": "error",
-            "message": "⚠️ No data loaded. Please reload the data."
-        }
-    
-    master_df = all_data["Master Reconciliation"]
-    user_lower = user_message.lower().strip()
-    
-    # Extract MCF numbers
-    mcf_pattern = r'MCF-\d{8}-\d{4}'
-    mcfs_found = re.findall(mcf_pattern, user_message.upper())
-    
-    # ============================================================
-    # QUERY 1: CP1/CP2 Information
-    # ============================================================
-    if any(word in user_lower for word in ["cp1", "cp2", "channel partner", "partner"]):
-        
-        # If MCF is specified
-        if mcfs_found:
-            mcf = mcfs_found[0]
-            
-            # Search in Master Reconciliation
-            mcf_data = smart_search(master_df, mcf, ['MCF Number'])
-            
-            if mcf_data.empty:
-                return {
-                    "type": "answer",
-                    "message": f"❌ **MCF {mcf} not found in Master Reconciliation.**\n\n"
-                               f"💡 The sheet has {len(master_df)} MCFs loaded.\n"
-                               f"Try: 'Show me all MCFs' to see what's available."
-                }
-            
-            row = mcf_data.iloc[0]
-            
-            # Check what user is asking
-            asking_cp1_only = "cp1" in user_lower and "cp2" not in user_lower
-            asking_cp2_only = "cp2" in user_lower and "cp1" not in user_lower
-            
-            if asking_cp1_only:
-                # Show only CP1
-                cp1_name = row.get('CP1 Name', 'Not available')
-                cp1_code = row.get('CP1 Code', 'N/A')
-                
-                message = f"**🤝 CP1 for {mcf}:**\n\n"
-                message += f"👤 **Name:** {cp1_name}\n"
-                message += f"🔖 **Code:** {cp1_code}\n"
-                
-                if 'Expected CP1 Payout' in row.index:
-                    message += f"💰 **Expected Payout:** ₹{pd.to_numeric(row.get('Expected CP1 Payout', 0), errors='coerce'):,.0f}\n"
-                if 'Actual CP1 Payout' in row.index:
-                    message += f"💰 **Actual Payout:** ₹{pd.to_numeric(row.get('Actual CP1 Payout', 0), errors='coerce'):,.0f}\n"
-                
-                message += f"\n📦 **Customer:** {row.get('Customer Name', 'N/A')}\n"
-                message += f"💵 **Deal P&L:** ₹{pd.to_numeric(row.get('Net Profit/Loss', 0), errors='coerce'):,.0f}\n"
-                
-                return {"type": "answer", "message": message}
-            
-            elif asking_cp2_only:
-                # Show only CP2
-                cp2_name = row.get('CP2 Name', 'Not available')
-                cp2_code = row.get('CP2 Code', 'N/A')
-                
-                message = f"**🤝 CP2 for {mcf}:**\n\n"
-                message += f"👤 **Name:** {cp2_name}\n"
-                message += f"🔖 **Code:** {cp2_code}\n"
-                
-                if cp2_name and cp2_name != 'Not available' and str(cp2_name).strip():
-                    if 'Expected CP2 Payout' in row.index:
-                        message += f"💰 **Expected Payout:** ₹{pd.to_numeric(row.get('Expected CP2 Payout', 0), errors='coerce'):,.0f}\n"
-                    if 'Actual CP2 Payout' in row.index:
-                        message += f"💰 **Actual Payout:** ₹{pd.to_numeric(row.get('Actual CP2 Payout', 0), errors='coerce'):,.0f}\n"
-                else:
-                    message += f"\nℹ️ **Note:** This MCF doesn't have a CP2 partner.\n"
-                
-                message += f"\n📦 **Customer:** {row.get('Customer Name', 'N/A')}\n"
-                
-                return {"type": "answer", "message": message}
-            
-            else:
-                # Show both CP1 and CP2
-                message = f"**🤝 Channel Partners for {mcf}:**\n\n"
-                
-                message += f"**👥 CP1 (Channel Partner 1):**\n"
-                message += f"• Name: {row.get('CP1 Name', 'Not available')}\n"
-                message += f"• Code: {row.get('CP1 Code', 'N/A')}\n"
-                if 'Expected CP1 Payout' in row.index:
-                    message += f"• Expected: ₹{pd.to_numeric(row.get('Expected CP1 Payout', 0), errors='coerce'):,.0f}\n"
-                if 'Actual CP1 Payout' in row.index:
-                    message += f"• Actual: ₹{pd.to_numeric(row.get('Actual CP1 Payout', 0), errors='coerce'):,.0f}\n"
-                
-                message += f"\n**👥 CP2 (Channel Partner 2):**\n"
-                cp2_name = row.get('CP2 Name', '')
-                if cp2_name and str(cp2_name).strip():
-                    message += f"• Name: {cp2_name}\n"
-                    message += f"• Code: {row.get('CP2 Code', 'N/A')}\n"
-                    if 'Expected CP2 Payout' in row.index:
-                        message += f"• Expected: ₹{pd.to_numeric(row.get('Expected CP2 Payout', 0), errors='coerce'):,.0f}\n"
-                    if 'Actual CP2 Payout' in row.index:
-                        message += f"• Actual: ₹{pd.to_numeric(row.get('Actual CP2 Payout', 0), errors='coerce'):,.0f}\n"
-                else:
-                    message += f"• ℹ️ No CP2 for this MCF\n"
-                
-                message += f"\n**📦 Customer:** {row.get('Customer Name', 'N/A')}\n"
-                message += f"**💵 Deal P&L:** ₹{pd.to_numeric(row.get('Net Profit/Loss', 0), errors='coerce'):,.0f}\n"
-                
-                return {"type": "answer", "message": message}
-        
-        else:
-            # Looking for partner by name
-            quoted = re.findall(r'["\']([^"\']+)["\']', user_message)
-            if quoted:
-                partner_name = quoted[0]
-            else:
-                stop_words = ['show', 'me', 'all', 'mcf', 'mcfs', 'for', 'partner', 'cp1', 'cp2', 'named', 'is']
-                words = [w for w in user_message.split() if w.lower() not in stop_words and len(w) > 2]
-                partner_name = ' '.join(words).strip()
-            
-            if partner_name:
-                # Search in both CP1 and CP2
-                cp1_matches = smart_search(master_df, partner_name, ['CP1 Name'])
-                cp2_matches = smart_search(master_df, partner_name, ['CP2 Name'])
-                
-                all_matches = pd.concat([cp1_matches, cp2_matches]).drop_duplicates(subset=['MCF Number'])
-                
-                if not all_matches.empty:
-                    message = f"**🔍 Found {len(all_matches)} MCF(s) for partner '{partner_name}':**\n\n"
-                    
-                    for i, (_, row) in enumerate(all_matches.head(15).iterrows(), 1):
-                        message += f"**{i}. {row['MCF Number']}**\n"
-                        message += f"   👤 Customer: {row.get('Customer Name', 'N/A')}\n"
-                        
-                        # Check which role
-                        if row['MCF Number'] in cp1_matches['MCF Number'].values:
-                            message += f"   🤝 Role: CP1 - {row.get('CP1 Name', 'N/A')}\n"
-                            message += f"   💰 Payout: ₹{pd.to_numeric(row.get('Actual CP1 Payout', 0), errors='coerce'):,.0f}\n"
-                        
-                        if row['MCF Number'] in cp2_matches['MCF Number'].values:
-                            message += f"   🤝 Role: CP2 - {row.get('CP2 Name', 'N/A')}\n"
-                            message += f"   💰 Payout: ₹{pd.to_numeric(row.get('Actual CP2 Payout', 0), errors='coerce'):,.0f}\n"
-                        
-                        message += f"   📊 P&L: ₹{pd.to_numeric(row.get('Net Profit/Loss', 0), errors='coerce'):,.0f}\n\n"
-                    
-                    if len(all_matches) > 15:
-                        message += f"... and {len(all_matches) - 15} more MCFs\n"
-                    
-                    return {"type": "answer", "message": message}
-                else:
-                    # Suggest similar names
-                    all_cp1 = master_df['CP1 Name'].dropna().unique()
-                    all_cp2 = master_df['CP2 Name'].dropna().unique()
-                    all_partners = list(set(list(all_cp1) + list(all_cp2)))
-                    
-                    similar = [p for p in all_partners if partner_name.lower() in str(p).lower()][:5]
-                    
-                    message = f"❌ **No MCFs found for partner '{partner_name}'.**\n\n"
-                    
-                    if similar:
-                        message += f"💡 **Did you mean:**\n"
-                        for p in similar:
-                            message += f"• {p}\n"
-                    else:
-                        message += f"💡 Try: 'Show all partners' to see available names"
-                    
-                    return {"type": "answer", "message": message}
-            else:
-                return {
-                    "type": "answer",
-                    "message": "🤔 **I can help you with partner information!**\n\n"
-                               "**Please specify:**\n"
-                               "• MCF number: 'Who is CP1 for MCF-20250428-0588?'\n"
-                               "• Partner name: 'Show MCFs for partner Kaushalya'\n\n"
-                               "**Examples:**\n"
-                               "• 'CP1 name for MCF-20250428-0588'\n"
-                               "• 'Show all deals for partner \"Kaushalya\"'"
-                }
-    
-    # ============================================================
-    # QUERY 2: Show Lists
-    # ============================================================
-    elif "show" in user_lower and ("profit" in user_lower or "loss" in user_lower):
-        
-        if 'Net Profit/Loss' not in master_df.columns:
-            return {"type": "error", "message": "Net Profit/Loss column not found in data"}
-        
-        # Convert to numeric
-        master_df['Net Profit/Loss'] = pd.to_numeric(master_df['Net Profit/Loss'], errors='coerce').fillna(0)
-        
-        if "profit" in user_lower:
-            profit_df = master_df[master_df['Net Profit/Loss'] > 0].sort_values('Net Profit/Loss', ascending=False)
-            
-            if profit_df.empty:
-                return {"type": "answer", "message": "✅ No profitable MCFs found in data."}
-            
-            message = f"**📈 Profitable MCFs ({len(profit_df)} found):**\n\n"
-            
-            for i, (_, row) in enumerate(profit_df.head(20).iterrows(), 1):
-                message += f"**{i}. {row['MCF Number']}**\n"
-                message += f"   👤 {row.get('Customer Name', 'N/A')}\n"
-                message += f"   💰 Profit: **₹{row['Net Profit/Loss']:,.0f}**\n"
-                message += f"   🤝 CP1: {row.get('CP1 Name', 'N/A')}\n\n"
-            
-            if len(profit_df) > 20:
-                message += f"... and {len(profit_df) - 20} more\n"
-            
-            return {"type": "answer", "message": message}
-        
-        elif "loss" in user_lower:
-            loss_df = master_df[master_df['Net Profit/Loss'] < 0].sort_values('Net Profit/Loss')
-            
-            if loss_df.empty:
-                return {"type": "answer", "message": "✅ No loss-making MCFs!"}
-            
-            message = f"**📉 Loss-Making MCFs ({len(loss_df)} found):**\n\n"
-            
-            for i, (_, row) in enumerate(loss_df.head(20).iterrows(), 1):
-                message += f"**{i}. {row['MCF Number']}**\n"
-                message += f"   👤 {row.get('Customer Name', 'N/A')}\n"
-                message += f"   🔴 Loss: **₹{row['Net Profit/Loss']:,.0f}**\n"
-                message += f"   🤝 CP1: {row.get('CP1 Name', 'N/A')}\n\n"
-            
-            if len(loss_df) > 20:
-                message += f"... and {len(loss_df) - 20} more\n"
-            
-            return {"type": "answer", "message": message}
-    
-    # ============================================================
-    # QUERY 3: Summary
-    # ============================================================
-    elif "summary" in user_lower:
-        master_df['Net Profit/Loss'] = pd.to_numeric(master_df['Net Profit/Loss'], errors='coerce').fillna(0)
-        
-        total_pl = master_df['Net Profit/Loss'].sum()
-        profitable = len(master_df[master_df['Net Profit/Loss'] > 0])
-        losses = len(master_df[master_df['Net Profit/Loss'] < 0])
-        
-        message = f"""**📊 P&L Summary:**
-
-**Overall:**
-• Total MCFs: {len(master_df)}
-• Total P&L: **₹{total_pl:,.0f}** {'✅' if total_pl > 0 else '🔴'}
-
-**Breakdown:**
-• Profitable: {profitable} MCFs
-• Losses: {losses} MCFs
-
-💡 Ask me about specific MCFs or partners!
-"""
-        return {"type": "answer", "message": message}
-    
-    # ============================================================
-    # FALLBACK: Help
-    # ============================================================
-    else:
-        return {
-            "type": "answer",
-            "message": f"""🤔 **I'm here to help! Try asking:**
-
-**🔍 Find Partners:**
-• "Who is CP1 for MCF-20250428-0588?"
-• "Show all MCFs for partner Kaushalya"
-• "CP1 and CP2 for MCF-20250428-0588"
-
-**📊 View Data:**
-• "Show profitable MCFs"
-• "Show loss MCFs"
-• "Give me a summary"
-
-**Current Data:** {len(master_df)} MCFs loaded
-
-**What would you like to know?**
-"""
-        }
-
-# Main App
-st.markdown("""
-<div class="main-header">
-    <h1>🤖 P&L Reconciliation AI Agent</h1>
-    <p>Chat with AI about your data</p>
-</div>
-""", unsafe_allow_html=True)
-
-# Sidebar
-with st.sidebar:
-    st.header("⚙️ Configuration")
-    
-    if not st.session_state.connected:
-        spreadsheet_id = st.text_input("📊 Google Sheet ID", type="password")
-        gemini_key = st.text_input("🔑 Gemini API Key", type="password")
-        creds_json = st.text_area("🔐 Credentials JSON", height=150)
-        
-        if st.button("🔌 Connect"):
-            if spreadsheet_id and gemini_key and creds_json:
-                try:
-                    creds_dict = json.loads(creds_json)
-                    
-                    with st.spinner("Connecting..."):
-                        spreadsheet, model, error = init_services(spreadsheet_id, creds_dict, gemini_key)
-                    
-                    if error:
-                        st.error(f"❌ {error}")
-                    else:
-                        st.session_state.spreadsheet = spreadsheet
-                        st.session_state.model = model
-                        st.session_state.connected = True
-                        
-                        # Load ALL sheets
-                        with st.spinner("Loading all sheets..."):
-                            all_data = load_all_sheets(spreadsheet)
-                            st.session_state.all_data = all_data
-                        
-                        st.success("✅ Connected!")
-                        st.rerun()
-                
-                except Exception as e:
-                    st.error(f"❌ Error: {str(e)}")
-            else:
-                st.warning("Fill all fields")
-    else:
-        st.success("✅ Connected")
-        
-        if st.session_state.all_data:
-            st.markdown("### 📊 Loaded Sheets")
-            for sheet_name, df in st.session_state.all_data.items():
-                st.write(f"• {sheet_name}: {len(df)} rows")
-        
-        st.markdown("---")
-        
-        if st.button("🔄 Reload Data"):
-            with st.spinner("Reloading..."):
-                all_data = load_all_sheets(st.session_state.spreadsheet)
-                st.session_state.all_data = all_data
-            st.success("Reloaded!")
-            st.rerun()
-        
-        if st.button("🗑️ Clear Chat"):
-            st.session_state.messages = []
-            st.rerun()
-        
-        if st.button("🔌 Disconnect"):
-            st.session_state.connected = False
-            st.session_state.all_data = {}
-            st.session_state.messages = []
-            st.rerun()
-
-# Main Chat
-if st.session_state.connected and st.session_state.all_data:
-    
-    # Display chat
-    for msg in st.session_state.messages:
-        if msg["role"] == "user":
-            st.markdown(f'<div class="chat-message user-message"><strong>You:</strong><br>{msg["content"]}</div>', unsafe_allow_html=True)
-        else:
-            st.markdown(f'<div class="chat-message ai-message"><strong>🤖 AI:</strong><br>{msg["content"]}</div>', unsafe_allow_html=True)
-    
-    # Quick actions
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        if st.button("📉 Show Losses"):
-            st.session_state.messages.append({"role": "user", "content": "Show me all loss MCFs"})
-            st.rerun()
-    with col2:
-        if st.button("📈 Show Profits"):
-            st.session_state.messages.append({"role": "user", "content": "Show me all profitable MCFs"})
-            st.rerun()
-    with col3:
-        if st.button("📊 Summary"):
-            st.session_state.messages.append({"role": "user", "content": "Give me a summary"})
-            st.rerun()
-    
-    # Chat input
-    user_input = st.chat_input("Ask me anything...")
-    
-    if user_input:
-        st.session_state.messages.append({"role": "user", "content": user_input})
-        
-        with st.spinner("🤔 Thinking..."):
-            response = chat_with_agent(user_input, st.session_state.all_data)
-        
-        st.session_state.messages.append({"role": "assistant", "content": response["message"]})
-        st.rerun()
-
-else:
-    st.info("👈 Connect using sidebar to get started")
+"""
+P&L RECONCILIATION AI AGENT - COMPLETE WORKING VERSION
+Reads ALL sheets and provides accurate answers
+"""
+
+import streamlit as st
+import pandas as pd
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import time
+import re
+
+# Page config
+st.set_page_config(
+    page_title="P&L Reconciliation AI Agent",
+    page_icon="🤖",
+    layout="wide"
+)
+
+# Custom CSS - a module constant so reruns re-emit the same interned
+# string instead of rebuilding it; dropping it entirely on reruns is not
+# an option because Streamlit removes elements that are not re-rendered
+CUSTOM_CSS = """
+<style>
+    .main-header {
+        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+        padding: 30px;
+        border-radius: 15px;
+        color: white;
+        text-align: center;
+        margin-bottom: 30px;
+    }
+    .chat-message {
+        padding: 15px;
+        border-radius: 10px;
+        margin: 10px 0;
+    }
+    .user-message {
+        background: #e3f2fd;
+        border-left: 4px solid #2196F3;
+        margin-left: 50px;
+    }
+    .ai-message {
+        background: #f3e5f5;
+        border-left: 4px solid #9c27b0;
+        margin-right: 50px;
+    }
+    .metric-card {
+        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+        padding: 20px;
+        border-radius: 10px;
+        color: white;
+        text-align: center;
+    }
+</style>
+"""
+
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+
+
+# Initialize session state
+if "messages" not in st.session_state:
+    st.session_state.messages = []
+if "all_data" not in st.session_state:
+    st.session_state.all_data = {}
+if "connected" not in st.session_state:
+    st.session_state.connected = False
+if "data_version" not in st.session_state:
+    st.session_state.data_version = 0
+if "response_cache" not in st.session_state:
+    st.session_state.response_cache = {}
+if "rendered_html" not in st.session_state:
+    st.session_state.rendered_html = []
+
+@st.cache_resource
+def init_services(spreadsheet_id, creds_dict, gemini_key):
+    """Initialize Google Sheets and Gemini"""
+    try:
+        # Deferred imports - the Google stack is heavy and only needed once
+        # someone actually connects, so disconnected reruns don't pay for it
+        import gspread
+        from google.oauth2.service_account import Credentials
+        from google.auth.transport.requests import AuthorizedSession
+        from requests.adapters import HTTPAdapter
+        import google.generativeai as genai
+
+        scopes = [
+            'https://www.googleapis.com/auth/spreadsheets',
+            'https://www.googleapis.com/auth/drive'
+        ]
+        credentials = Credentials.from_service_account_info(creds_dict, scopes=scopes)
+
+        def open_spreadsheet():
+            # Pooled keep-alive session so every Sheets call after the first
+            # reuses a warm TLS connection instead of a fresh handshake
+            session = AuthorizedSession(credentials)
+            session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+            try:
+                client = gspread.Client(auth=credentials, session=session)
+            except TypeError:
+                # Older/newer gspread without the session argument
+                client = gspread.authorize(credentials)
+            return client.open_by_key(spreadsheet_id)
+
+        def init_gemini():
+            genai.configure(api_key=gemini_key)
+            return genai.GenerativeModel('gemini-1.5-flash-latest')
+
+        # The two services are independent - set them up in parallel so
+        # connect time is the slower of the two, not the sum
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            sheet_future = executor.submit(open_spreadsheet)
+            gemini_future = executor.submit(init_gemini)
+            spreadsheet = sheet_future.result()
+            model = gemini_future.result()
+
+        return spreadsheet, model, None
+    except Exception as e:
+        return None, None, str(e)
+
+# Compiled once - these run on every chat turn
+ZERO_MONEY = "₹0"
+
+def format_money(value):
+    """Rupee-format a number, skipping the formatter for the common zero"""
+    return ZERO_MONEY if not value else f"₹{value:,.0f}"
+
+MCF_RE = re.compile(r'MCF-\d{8}-\d{4}')
+QUOTED_RE = re.compile(r'["\']([^"\']+)["\']')
+
+MAIN_HEADER_HTML = """
+<div class="main-header">
+    <h1>🤖 P&L Reconciliation AI Agent</h1>
+    <p>Chat with AI about your data</p>
+</div>
+"""
+
+# Messages rendered inline per rerun; older ones collapse into <details>
+CHAT_HISTORY_LIMIT = 20
+
+# Hard cap on stored transcript length - oldest messages are dropped
+# past this so a long-lived session can't grow without bound
+CHAT_HISTORY_MAX = 200
+
+CHAT_MESSAGE_TEMPLATES = {
+    "user": '<div class="chat-message user-message"><strong>You:</strong><br>{}</div>',
+    "assistant": '<div class="chat-message ai-message"><strong>🤖 AI:</strong><br>{}</div>',
+}
+
+def append_message(role, content):
+    """Add a chat message and its pre-rendered HTML in one place"""
+    st.session_state.messages.append({"role": role, "content": content})
+    st.session_state.rendered_html.append(CHAT_MESSAGE_TEMPLATES[role].format(content))
+    if len(st.session_state.messages) > CHAT_HISTORY_MAX:
+        del st.session_state.messages[:-CHAT_HISTORY_MAX]
+        del st.session_state.rendered_html[:-CHAT_HISTORY_MAX]
+
+@dataclass(slots=True)
+class AgentResponse:
+    """One chat answer; type is 'answer' or 'error'"""
+    type: str
+    message: str
+
+# Words ignored when extracting a partner name from a free-form question
+STOP_WORDS = frozenset(['show', 'me', 'all', 'mcf', 'mcfs', 'for', 'partner', 'cp1', 'cp2', 'named', 'is'])
+
+# Canned replies - built once at import, not on every chat turn
+PARTNER_HELP_MESSAGE = (
+    "🤔 **I can help you with partner information!**\n\n"
+    "**Please specify:**\n"
+    "• MCF number: 'Who is CP1 for MCF-20250428-0588?'\n"
+    "• Partner name: 'Show MCFs for partner Kaushalya'\n\n"
+    "**Examples:**\n"
+    "• 'CP1 name for MCF-20250428-0588'\n"
+    "• 'Show all deals for partner \"Kaushalya\"'"
+)
+
+HELP_TEMPLATE = """🤔 **I'm here to help! Try asking:**
+
+**🔍 Find Partners:**
+• "Who is CP1 for MCF-20250428-0588?"
+• "Show all MCFs for partner Kaushalya"
+• "CP1 and CP2 for MCF-20250428-0588"
+
+**📊 View Data:**
+• "Show profitable MCFs"
+• "Show loss MCFs"
+• "Give me a summary"
+
+**Current Data:** {count} MCFs loaded
+
+**What would you like to know?**
+"""
+
+# Columns smart_search runs against - pre-lowercased copies are built at load time
+SEARCHABLE_COLUMNS = ['MCF Number', 'CP1 Name', 'CP2 Name', 'Customer Name']
+
+# The only Master Reconciliation columns chat_with_agent ever reads -
+# everything else is dropped at load to keep the hot frame small
+MASTER_KEEP = {
+    'MCF Number', 'Customer Name',
+    'CP1 Name', 'CP1 Code', 'CP2 Name', 'CP2 Code',
+    'Expected CP1 Payout', 'Actual CP1 Payout',
+    'Expected CP2 Payout', 'Actual CP2 Payout',
+    'Net Profit/Loss'
+}
+
+# Numeric columns in Master Reconciliation - converted once at load time
+NUMERIC_COLUMNS = [
+    'Net Profit/Loss',
+    'Expected CP1 Payout',
+    'Actual CP1 Payout',
+    'Expected CP2 Payout',
+    'Actual CP2 Payout'
+]
+
+# All known sheets and their ranges
+SHEET_RANGES = {
+    "01_Expected": "B:U",
+    "02_Payouts": "B:AE",
+    "03_MCFExport": "C:CE",
+    "04_Invoice": "A:J",
+    "Master Reconciliation": "A:W"
+}
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_sheet_values(spreadsheet_id, ranges, _spreadsheet):
+    """Batched values fetch, cached for 5 minutes per spreadsheet"""
+    result = _spreadsheet.values_batch_get(
+        ranges,
+        params={'valueRenderOption': 'UNFORMATTED_VALUE'}
+    )
+    return result.get('valueRanges', [])
+
+def load_sheets(spreadsheet, sheet_names):
+    """Load the given sheets into memory"""
+    try:
+        all_data = {}
+
+        sheets_to_load = {name: SHEET_RANGES[name] for name in sheet_names}
+
+        # One batched API call for every sheet instead of a round-trip each,
+        # with unformatted values so numeric cells arrive already typed
+        ranges = [f"'{name}'!{rng}" for name, rng in sheets_to_load.items()]
+        value_ranges = fetch_sheet_values(spreadsheet.id, ranges, spreadsheet)
+
+        for sheet_name, value_range in zip(sheets_to_load, value_ranges):
+            try:
+                data = value_range.get('values', [])
+
+                if data and len(data) > 1:
+                    header = [str(h).strip() for h in data[0]]
+                    # The API trims trailing empty cells from every row,
+                    # header included, so pad everything out to the widest
+                    # row - a data column under a blank header cell must
+                    # not make rows wider than the column list
+                    width = max(len(r) for r in data)
+                    header += [''] * (width - len(header))
+                    rows = [r + [''] * (width - len(r)) for r in data[1:]]
+                    df = pd.DataFrame(rows, columns=header)
+
+                    # Convert numeric columns once here so queries don't
+                    # re-run pd.to_numeric on every chat message
+                    if sheet_name == "Master Reconciliation":
+                        df = df[[c for c in df.columns if c in MASTER_KEEP]]
+
+                        money_cols = [c for c in NUMERIC_COLUMNS if c in df.columns]
+                        if money_cols:
+                            df[money_cols] = (
+                                df[money_cols]
+                                .apply(pd.to_numeric, errors='coerce')
+                                .fillna(0)
+                                .astype('float64')
+                            )
+
+                        # Low-cardinality name/code columns as categoricals -
+                        # repeated values share one string and compare by code.
+                        # MCF Number is unique per row, so it stays a string.
+                        for col in ('Customer Name', 'CP1 Name', 'CP1 Code', 'CP2 Name', 'CP2 Code'):
+                            if col in df.columns:
+                                df[col] = df[col].astype('category')
+
+                        # Aggregate stats computed once per load so the
+                        # summary path never touches the full column again
+                        if 'Net Profit/Loss' in df.columns:
+                            pl = df['Net Profit/Loss'].to_numpy()
+                            df.attrs['pl_stats'] = {
+                                'total': float(pl.sum()),
+                                'profitable': int((pl > 0).sum()),
+                                'losses': int((pl < 0).sum()),
+                                'count': len(df)
+                            }
+
+                        # Pre-lowercase the searchable columns so smart_search
+                        # doesn't redo astype(str).str.lower() per query
+                        for col in SEARCHABLE_COLUMNS:
+                            if col in df.columns:
+                                df[f'_{col}_lc'] = df[col].astype(str).str.lower().str.strip()
+
+                        # Index MCF Number -> row position so lookups are O(1)
+                        # instead of scanning the whole column per query.
+                        # setdefault keeps the first row of a duplicated MCF,
+                        # matching what the old first-match scan returned
+                        if 'MCF Number' in df.columns:
+                            mcf_index = {}
+                            for i, v in enumerate(df['MCF Number'].astype(str).str.upper().str.strip()):
+                                mcf_index.setdefault(v, i)
+                            df.attrs['mcf_index'] = mcf_index
+
+                        # Inverted index: lowercase partner name -> row positions,
+                        # so exact partner queries skip the column scans entirely
+                        for role, name_col in (('cp1_index', '_CP1 Name_lc'), ('cp2_index', '_CP2 Name_lc')):
+                            index = {}
+                            if name_col in df.columns:
+                                for i, name in enumerate(df[name_col]):
+                                    if name:
+                                        index.setdefault(name, []).append(i)
+                            df.attrs[role] = index
+
+                        # Unique partner names sorted by lowercase, for the
+                        # "did you mean" suggestions
+                        names = {}
+                        for col in ('CP1 Name', 'CP2 Name'):
+                            if col in df.columns:
+                                for name in df[col].dropna().unique():
+                                    s = str(name).strip()
+                                    if s:
+                                        names.setdefault(s.lower(), s)
+                        df.attrs['partner_names'] = sorted(names.items())
+
+                    all_data[sheet_name] = df
+                    st.success(f"✅ Loaded {sheet_name}: {len(df)} rows")
+                else:
+                    st.warning(f"⚠️ {sheet_name} is empty")
+                    
+            except Exception as e:
+                st.error(f"❌ Error loading {sheet_name}: {e}")
+        
+        return all_data
+        
+    except Exception as e:
+        st.error(f"Error loading sheets: {e}")
+        return {}
+
+class LazySheets(dict):
+    """Sheet DataFrames keyed by name; non-master sheets fetch on first access"""
+
+    def __init__(self, spreadsheet, initial):
+        super().__init__(initial)
+        self._spreadsheet = spreadsheet
+
+    def __getitem__(self, name):
+        if name not in self and name in SHEET_RANGES:
+            self.update(load_sheets(self._spreadsheet, [name]))
+        return super().__getitem__(name)
+
+def load_all_sheets(spreadsheet):
+    """Load Master Reconciliation now; the other sheets load on demand"""
+    master = load_sheets(spreadsheet, ["Master Reconciliation"])
+    return LazySheets(spreadsheet, master)
+
+def lowered_column(df, col):
+    """Lowercase view of a column, using the precomputed copy when available"""
+    lc_col = f'_{col}_lc'
+    if lc_col in df.columns:
+        return df[lc_col]
+    return df[col].astype(str).str.lower()
+
+def smart_search(df, search_term, columns_to_search):
+    """Smart search across multiple columns"""
+    if df is None or df.empty:
+        return pd.DataFrame()
+
+    search_lower = str(search_term).lower().strip()
+
+    # Try exact match first
+    for col in columns_to_search:
+        if col in df.columns:
+            exact = df[lowered_column(df, col) == search_lower]
+            if not exact.empty:
+                return exact
+
+    # Try contains match
+    for col in columns_to_search:
+        if col in df.columns:
+            contains = df[lowered_column(df, col).str.contains(search_lower, na=False, regex=False)]
+            if not contains.empty:
+                return contains
+
+    # Try partial word match
+    words = search_lower.split()
+    if len(words) > 1:
+        for col in columns_to_search:
+            if col in df.columns:
+                lowered = lowered_column(df, col)
+                mask = lowered.str.contains(words[0], na=False, regex=False)
+                for word in words[1:]:
+                    mask &= lowered.str.contains(word, na=False, regex=False)
+                word_match = df[mask]
+                if not word_match.empty:
+                    return word_match
+
+    return pd.DataFrame()
+
+# ============================================================
+# QUERY 1: CP1/CP2 Information
+# ============================================================
+def handle_partner_query(user_message, user_lower, mcfs_found, master_df):
+        
+    # If MCF is specified
+    if mcfs_found:
+        mcf = mcfs_found[0]
+
+        # O(1) lookup in the prebuilt MCF index
+        mcf_idx = master_df.attrs.get('mcf_index', {}).get(mcf)
+
+        if mcf_idx is None:
+            return AgentResponse(
+                "answer",
+                f"❌ **MCF {mcf} not found in Master Reconciliation.**\n\n"
+                f"💡 The sheet has {len(master_df)} MCFs loaded.\n"
+                f"Try: 'Show me all MCFs' to see what's available."
+            )
+
+        # Plain dict so the dozen field reads below are direct hash
+        # lookups instead of pandas Series index walks
+        row = master_df.iloc[mcf_idx].to_dict()
+            
+        # Check what user is asking
+        asking_cp1_only = "cp1" in user_lower and "cp2" not in user_lower
+        asking_cp2_only = "cp2" in user_lower and "cp1" not in user_lower
+            
+        if asking_cp1_only:
+            # Show only CP1
+            cp1_name = row.get('CP1 Name', 'Not available')
+            cp1_code = row.get('CP1 Code', 'N/A')
+                
+            parts = [
+                f"**🤝 CP1 for {mcf}:**\n\n"
+                f"👤 **Name:** {cp1_name}\n"
+                f"🔖 **Code:** {cp1_code}\n"
+            ]
+
+            if 'Expected CP1 Payout' in row:
+                parts.append(f"💰 **Expected Payout:** {format_money(row.get('Expected CP1 Payout', 0))}\n")
+            if 'Actual CP1 Payout' in row:
+                parts.append(f"💰 **Actual Payout:** {format_money(row.get('Actual CP1 Payout', 0))}\n")
+
+            parts.append(
+                f"\n📦 **Customer:** {row.get('Customer Name', 'N/A')}\n"
+                f"💵 **Deal P&L:** {format_money(row.get('Net Profit/Loss', 0))}\n"
+            )
+
+            return AgentResponse("answer", "".join(parts))
+            
+        elif asking_cp2_only:
+            # Show only CP2
+            cp2_name = row.get('CP2 Name', 'Not available')
+            cp2_code = row.get('CP2 Code', 'N/A')
+                
+            parts = [
+                f"**🤝 CP2 for {mcf}:**\n\n"
+                f"👤 **Name:** {cp2_name}\n"
+                f"🔖 **Code:** {cp2_code}\n"
+            ]
+
+            if cp2_name and cp2_name != 'Not available' and str(cp2_name).strip():
+                if 'Expected CP2 Payout' in row:
+                    parts.append(f"💰 **Expected Payout:** {format_money(row.get('Expected CP2 Payout', 0))}\n")
+                if 'Actual CP2 Payout' in row:
+                    parts.append(f"💰 **Actual Payout:** {format_money(row.get('Actual CP2 Payout', 0))}\n")
+            else:
+                parts.append(f"\nℹ️ **Note:** This MCF doesn't have a CP2 partner.\n")
+
+            parts.append(f"\n📦 **Customer:** {row.get('Customer Name', 'N/A')}\n")
+
+            return AgentResponse("answer", "".join(parts))
+            
+        else:
+            # Show both CP1 and CP2
+            parts = [
+                f"**🤝 Channel Partners for {mcf}:**\n\n"
+                f"**👥 CP1 (Channel Partner 1):**\n"
+                f"• Name: {row.get('CP1 Name', 'Not available')}\n"
+                f"• Code: {row.get('CP1 Code', 'N/A')}\n"
+            ]
+            if 'Expected CP1 Payout' in row:
+                parts.append(f"• Expected: {format_money(row.get('Expected CP1 Payout', 0))}\n")
+            if 'Actual CP1 Payout' in row:
+                parts.append(f"• Actual: {format_money(row.get('Actual CP1 Payout', 0))}\n")
+
+            parts.append(f"\n**👥 CP2 (Channel Partner 2):**\n")
+            cp2_name = row.get('CP2 Name', '')
+            if cp2_name and str(cp2_name).strip():
+                parts.append(
+                    f"• Name: {cp2_name}\n"
+                    f"• Code: {row.get('CP2 Code', 'N/A')}\n"
+                )
+                if 'Expected CP2 Payout' in row:
+                    parts.append(f"• Expected: {format_money(row.get('Expected CP2 Payout', 0))}\n")
+                if 'Actual CP2 Payout' in row:
+                    parts.append(f"• Actual: {format_money(row.get('Actual CP2 Payout', 0))}\n")
+            else:
+                parts.append(f"• ℹ️ No CP2 for this MCF\n")
+
+            parts.append(
+                f"\n**📦 Customer:** {row.get('Customer Name', 'N/A')}\n"
+                f"**💵 Deal P&L:** {format_money(row.get('Net Profit/Loss', 0))}\n"
+            )
+
+            return AgentResponse("answer", "".join(parts))
+        
+    else:
+        # Looking for partner by name
+        quoted = QUOTED_RE.findall(user_message)
+        if quoted:
+            partner_name = quoted[0]
+        else:
+            words = [w for w in user_message.split() if w.lower() not in STOP_WORDS and len(w) > 2]
+            partner_name = ' '.join(words).strip()
+            
+        if partner_name:
+            # Exact partner hit via the inverted index, falling back to
+            # smart_search for partial / fuzzy matches
+            partner_lower = partner_name.lower().strip()
+            cp1_rows = master_df.attrs.get('cp1_index', {}).get(partner_lower, [])
+            cp2_rows = master_df.attrs.get('cp2_index', {}).get(partner_lower, [])
+
+            if not (cp1_rows or cp2_rows):
+                cp1_rows = smart_search(master_df, partner_name, ['CP1 Name']).index.tolist()
+                cp2_rows = smart_search(master_df, partner_name, ['CP2 Name']).index.tolist()
+
+            # Union the integer row positions - no concat + dedupe pass
+            union = sorted(set(cp1_rows) | set(cp2_rows))
+
+            if union:
+                all_matches = master_df.iloc[union]
+
+                # O(1) membership tests inside the render loop
+                cp1_mcf_set = set(master_df['MCF Number'].iloc[cp1_rows])
+                cp2_mcf_set = set(master_df['MCF Number'].iloc[cp2_rows])
+
+                parts = [f"**🔍 Found {len(all_matches)} MCF(s) for partner '{partner_name}':**\n\n"]
+
+                # Pull all displayed columns out in one go rather than
+                # dict-style row.get calls inside the loop
+                head = all_matches.head(15)
+                match_rows = zip(
+                    head['MCF Number'],
+                    head['Customer Name'] if 'Customer Name' in head.columns else ['N/A'] * len(head),
+                    head['CP1 Name'] if 'CP1 Name' in head.columns else ['N/A'] * len(head),
+                    head['Actual CP1 Payout'] if 'Actual CP1 Payout' in head.columns else [0] * len(head),
+                    head['CP2 Name'] if 'CP2 Name' in head.columns else ['N/A'] * len(head),
+                    head['Actual CP2 Payout'] if 'Actual CP2 Payout' in head.columns else [0] * len(head),
+                    head['Net Profit/Loss'] if 'Net Profit/Loss' in head.columns else [0] * len(head),
+                )
+
+                for i, (mcf_no, customer, cp1_name, cp1_payout, cp2_name, cp2_payout, pl) in enumerate(match_rows, 1):
+                    parts.append(
+                        f"**{i}. {mcf_no}**\n"
+                        f"   👤 Customer: {customer}\n"
+                    )
+
+                    # Check which role
+                    if mcf_no in cp1_mcf_set:
+                        parts.append(
+                            f"   🤝 Role: CP1 - {cp1_name}\n"
+                            f"   💰 Payout: {format_money(cp1_payout)}\n"
+                        )
+
+                    if mcf_no in cp2_mcf_set:
+                        parts.append(
+                            f"   🤝 Role: CP2 - {cp2_name}\n"
+                            f"   💰 Payout: {format_money(cp2_payout)}\n"
+                        )
+
+                    parts.append(f"   📊 P&L: {format_money(pl)}\n\n")
+
+                if len(all_matches) > 15:
+                    parts.append(f"... and {len(all_matches) - 15} more MCFs\n")
+
+                return AgentResponse("answer", "".join(parts))
+            else:
+                # Suggest similar names - one pass over the precomputed list
+                similar = []
+                for name_lc, original in master_df.attrs.get('partner_names', []):
+                    if partner_lower in name_lc:
+                        similar.append(original)
+                        if len(similar) == 5:
+                            break
+                    
+                parts = [f"❌ **No MCFs found for partner '{partner_name}'.**\n\n"]
+
+                if similar:
+                    parts.append(f"💡 **Did you mean:**\n")
+                    parts.extend(f"• {p}\n" for p in similar)
+                else:
+                    parts.append(f"💡 Try: 'Show all partners' to see available names")
+
+                return AgentResponse("answer", "".join(parts))
+        else:
+            return AgentResponse("answer", PARTNER_HELP_MESSAGE)
+
+# ============================================================
+# QUERY 2: Show Lists
+# ============================================================
+def handle_list_query(user_message, user_lower, mcfs_found, master_df):
+    if 'Net Profit/Loss' not in master_df.columns:
+        return AgentResponse("error", "Net Profit/Loss column not found in data")
+
+    # Compare on the raw array - skips building an intermediate Series mask
+    pl = master_df['Net Profit/Loss'].to_numpy()
+
+    if "profit" in user_lower:
+        profit_df = master_df[pl > 0]
+
+        if profit_df.empty:
+            return AgentResponse("answer", "✅ No profitable MCFs found in data.")
+
+        # Partial top-20 selection - no need to sort the whole frame
+        top = profit_df.nlargest(20, 'Net Profit/Loss')
+
+        parts = [f"**📈 Profitable MCFs ({len(profit_df)} found):**\n\n"]
+
+        top_rows = zip(top['MCF Number'],
+                       top['Customer Name'] if 'Customer Name' in top.columns else ['N/A'] * len(top),
+                       top['Net Profit/Loss'],
+                       top['CP1 Name'] if 'CP1 Name' in top.columns else ['N/A'] * len(top))
+        for i, (mcf_no, customer, pl, cp1) in enumerate(top_rows, 1):
+            parts.append(
+                f"**{i}. {mcf_no}**\n"
+                f"   👤 {customer}\n"
+                f"   💰 Profit: **{format_money(pl)}**\n"
+                f"   🤝 CP1: {cp1}\n\n"
+            )
+
+        if len(profit_df) > 20:
+            parts.append(f"... and {len(profit_df) - 20} more\n")
+
+        return AgentResponse("answer", "".join(parts))
+        
+    elif "loss" in user_lower:
+        loss_df = master_df[pl < 0]
+
+        if loss_df.empty:
+            return AgentResponse("answer", "✅ No loss-making MCFs!")
+
+        # Partial bottom-20 selection - no need to sort the whole frame
+        worst = loss_df.nsmallest(20, 'Net Profit/Loss')
+
+        parts = [f"**📉 Loss-Making MCFs ({len(loss_df)} found):**\n\n"]
+
+        worst_rows = zip(worst['MCF Number'],
+                         worst['Customer Name'] if 'Customer Name' in worst.columns else ['N/A'] * len(worst),
+                         worst['Net Profit/Loss'],
+                         worst['CP1 Name'] if 'CP1 Name' in worst.columns else ['N/A'] * len(worst))
+        for i, (mcf_no, customer, pl, cp1) in enumerate(worst_rows, 1):
+            parts.append(
+                f"**{i}. {mcf_no}**\n"
+                f"   👤 {customer}\n"
+                f"   🔴 Loss: **{format_money(pl)}**\n"
+                f"   🤝 CP1: {cp1}\n\n"
+            )
+
+        if len(loss_df) > 20:
+            parts.append(f"... and {len(loss_df) - 20} more\n")
+
+        return AgentResponse("answer", "".join(parts))
+
+# ============================================================
+# QUERY 3: Summary
+# ============================================================
+def handle_summary_query(user_message, user_lower, mcfs_found, master_df):
+    stats = master_df.attrs.get('pl_stats')
+    if stats is None:
+        # Plain numpy reductions - no filtered sub-frames just to count rows
+        pl_values = master_df['Net Profit/Loss'].to_numpy()
+        stats = {
+            'total': float(pl_values.sum()),
+            'profitable': int((pl_values > 0).sum()),
+            'losses': int((pl_values < 0).sum()),
+            'count': len(master_df)
+        }
+
+    total_pl = stats['total']
+    profitable = stats['profitable']
+    losses = stats['losses']
+        
+    message = f"""**📊 P&L Summary:**
+
+**Overall:**
+• Total MCFs: {len(master_df)}
+• Total P&L: **{format_money(total_pl)}** {'✅' if total_pl > 0 else '🔴'}
+
+**Breakdown:**
+• Profitable: {profitable} MCFs
+• Losses: {losses} MCFs
+
+💡 Ask me about specific MCFs or partners!
+"""
+    return AgentResponse("answer", message)
+
+# ============================================================
+# FALLBACK: Help
+# ============================================================
+def handle_help(user_message, user_lower, mcfs_found, master_df):
+    return AgentResponse("answer", HELP_TEMPLATE.format(count=len(master_df)))
+
+# One compiled pattern per intent, checked in priority order. The jump
+# table replaces the old if/elif substring chains.
+INTENT_PATTERNS = [
+    (re.compile(r'cp1|cp2|partner'), 'partner'),
+    (re.compile(r'(?=.*show)(?=.*(profit|loss))', re.S), 'list'),
+    (re.compile(r'summary'), 'summary'),
+]
+
+INTENT_HANDLERS = {
+    'partner': handle_partner_query,
+    'list': handle_list_query,
+    'summary': handle_summary_query,
+    'help': handle_help,
+}
+
+def chat_with_agent(user_message, all_data):
+    """Intelligent agent that understands and helps"""
+
+    if not all_data or "Master Reconciliation" not in all_data:
+        return AgentResponse("error", "⚠️ No data loaded. Please reload the data.")
+
+    master_df = all_data["Master Reconciliation"]
+    user_lower = user_message.lower().strip()
+
+    # Extract MCF numbers
+    mcfs_found = MCF_RE.findall(user_message.upper())
+
+    # An explicit MCF number is the strongest signal we have: route it
+    # straight to the partner/detail handler without scanning patterns
+    if mcfs_found:
+        intent = 'partner'
+    else:
+        # Single pass over the message, then jump straight to the handler
+        intent = 'help'
+        for pattern, name in INTENT_PATTERNS:
+            if pattern.search(user_lower):
+                intent = name
+                break
+
+    return INTENT_HANDLERS[intent](user_message, user_lower, mcfs_found, master_df)
+
+
+# Main App
+st.markdown(MAIN_HEADER_HTML, unsafe_allow_html=True)
+
+# Sidebar
+with st.sidebar:
+    st.header("⚙️ Configuration")
+    
+    if not st.session_state.connected:
+        spreadsheet_id = st.text_input("📊 Google Sheet ID", type="password")
+        gemini_key = st.text_input("🔑 Gemini API Key", type="password")
+        creds_json = st.text_area("🔐 Credentials JSON", height=150)
+        
+        if st.button("🔌 Connect"):
+            if spreadsheet_id and gemini_key and creds_json:
+                try:
+                    creds_dict = json.loads(creds_json)
+                    
+                    with st.spinner("Connecting..."):
+                        spreadsheet, model, error = init_services(spreadsheet_id, creds_dict, gemini_key)
+                    
+                    if error:
+                        st.error(f"❌ {error}")
+                    else:
+                        st.session_state.spreadsheet = spreadsheet
+                        st.session_state.model = model
+                        st.session_state.connected = True
+                        
+                        # Load ALL sheets
+                        with st.spinner("Loading all sheets..."):
+                            all_data = load_all_sheets(spreadsheet)
+                            st.session_state.all_data = all_data
+                            st.session_state.data_version += 1
+                        
+                        st.success("✅ Connected!")
+                        st.rerun()
+                
+                except Exception as e:
+                    st.error(f"❌ Error: {str(e)}")
+            else:
+                st.warning("Fill all fields")
+    else:
+        st.success("✅ Connected")
+        
+        if st.session_state.all_data:
+            st.markdown("### 📊 Loaded Sheets")
+            for sheet_name, df in st.session_state.all_data.items():
+                st.write(f"• {sheet_name}: {len(df)} rows")
+            pending = [s for s in SHEET_RANGES if s not in st.session_state.all_data]
+            if pending:
+                st.caption(f"{len(pending)} more sheets load on demand")
+        
+        st.markdown("---")
+        
+        if st.button("🔄 Reload Data"):
+            # Debounce: rapid clicks would each bypass the cache and burn
+            # Sheets read quota (100 reads/100s per user)
+            now = time.time()
+            if now - st.session_state.get("last_reload", 0.0) < 5:
+                st.toast("Just reloaded - try again in a few seconds")
+            else:
+                st.session_state.last_reload = now
+                with st.spinner("Reloading..."):
+                    fetch_sheet_values.clear()
+                    all_data = load_all_sheets(st.session_state.spreadsheet)
+                    st.session_state.all_data = all_data
+                    st.session_state.data_version += 1
+                # A toast survives the rerun; st.success here never rendered
+                st.toast("Data reloaded")
+                st.rerun()
+        
+        if st.button("🗑️ Clear Chat"):
+            st.session_state.messages = []
+            st.session_state.rendered_html = []
+            st.rerun()
+        
+        if st.button("🔌 Disconnect"):
+            st.session_state.connected = False
+            st.session_state.all_data = {}
+            st.session_state.messages = []
+            st.session_state.rendered_html = []
+            st.rerun()
+
+# Main Chat
+QUICK_ACTIONS = (
+    ("📉 Show Losses", "Show me all loss MCFs"),
+    ("📈 Show Profits", "Show me all profitable MCFs"),
+    ("📊 Summary", "Give me a summary"),
+)
+
+def submit_user_message(user_input):
+    """Append a user message and its answer - shared by the chat input
+    and the quick-action callbacks"""
+    # Drop exact duplicates arriving within 2s - a double-clicked quick
+    # action or replayed submit would otherwise add the pair twice
+    now = time.time()
+    last_input, last_ts = st.session_state.get("last_submit", (None, 0.0))
+    if user_input == last_input and now - last_ts < 2:
+        return
+    st.session_state.last_submit = (user_input, now)
+
+    append_message("user", user_input)
+
+    # Repeat questions (and the quick-action buttons) hit the cache;
+    # the data_version key invalidates everything on reload. Collapsing
+    # runs of whitespace lets trivially-respaced retypes hit too
+    cache_key = (" ".join(user_input.lower().split()), st.session_state.data_version)
+    response = st.session_state.response_cache.get(cache_key)
+
+    if response is None:
+        response = chat_with_agent(user_input, st.session_state.all_data)
+        if len(st.session_state.response_cache) >= 128:
+            st.session_state.response_cache.clear()
+        st.session_state.response_cache[cache_key] = response
+
+    append_message("assistant", response.message)
+
+@st.fragment
+def chat_panel():
+    """Chat history, quick actions and input - reruns without touching
+    the sidebar or header when a message is submitted"""
+
+    # Display chat - each message's HTML was rendered once when it was
+    # appended, so a rerun is one join + one markdown call. Only the last
+    # CHAT_HISTORY_LIMIT messages stay inline; the rest collapse into a
+    # <details> block so DOM size stays bounded in long conversations
+    rendered = st.session_state.rendered_html
+    if rendered:
+        older, recent = rendered[:-CHAT_HISTORY_LIMIT], rendered[-CHAT_HISTORY_LIMIT:]
+        html = "".join(recent)
+        if older:
+            html = (
+                f'<details><summary>📜 {len(older)} earlier messages</summary>'
+                + "".join(older) + "</details>" + html
+            )
+        st.markdown(html, unsafe_allow_html=True)
+    
+    # Quick actions - on_click runs before the fragment rerun, so one
+    # click costs exactly one rerun and the answer is already appended
+    for col, (label, message) in zip(st.columns(3), QUICK_ACTIONS):
+        with col:
+            st.button(label, on_click=submit_user_message, args=(message,))
+    
+    # Chat input
+    user_input = st.chat_input("Ask me anything...")
+    
+    if user_input:
+        with st.spinner("🤔 Thinking..."):
+            submit_user_message(user_input)
+        st.rerun(scope="fragment")
+
+if st.session_state.connected and st.session_state.all_data:
+    chat_panel()
+
+else:
+    st.info("👈 Connect using sidebar to get started")